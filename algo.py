@@ -1,83 +1,338 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+import bisect
+import time
 from typing import *
 
 import numpy as np
+import scipy.sparse as sp
 
 from data import *
-from log import log
+from log import Lazy, log
+from metrics import metrics
 
 
-def _risk(cnt: int, traj: Trajectory, itds: Dict[int, ITD]) -> float:
+def _risk(cnt: int, traj: Trajectory, itds: Population) -> float:
     """ Gets the risk value for the given trajectory with a specific
         count.
     """
-    return cnt / sum(itd.count(traj) for _, itd in itds.items())
+    return cnt / itds.global_count(traj)
 
 
-def _find_riskest(uid: int, itds: ITD) -> Trajectory:
+def _find_riskest(uid: int, itds: Population) -> Trajectory:
     """ Find the trajectory with the highest risk value in an ITD.
     """
-    itd = itds[uid]
-    return max([[t, _risk(itd.count(t), t, itds)] for t in itd.trajectories],
-               key=lambda x: x[1]
-              )[0]
+    store = itds.store
+    span = store.span(store.row(uid))
+    risk = store.counts[span] / itds.gcnt[store.tids[span]]
+    return store.trajectories[store.tids[span][np.argmax(risk)]]
+
+
+def _find_risky(
+        itds: Population,
+        p: float,                    # Risk threshold
+        top_k: Optional[int] = None  # Maximum number of trajectories per user
+        ) -> Dict[int, List[Trajectory]]:
+    """ Finds the trajectories of each user with a risk value of at least
+        p, sorted by their risk value in a descending order. Trajectories
+        of equal risk keep their order in the ITD. Users without risky
+        trajectories are left out.
+    """
+    store = itds.store
+    gcnt = itds.gcnt
+    # No user can reach the threshold on a trajectory whose largest count
+    # is below p times its global count. Only the entries of the other
+    # trajectories are scored, and users without any are pruned.
+    tmax = np.zeros(len(store.trajectories), dtype=np.int64)
+    np.maximum.at(tmax, store.tids, store.counts)
+    entries = np.flatnonzero((tmax / gcnt >= p)[store.tids])
+    rows = store.rows()[entries]
+    n_pruned = len(store) - int(np.count_nonzero(np.diff(rows, prepend=-1)))
+    log.info("Pruned %d of %d users without risky trajectories",
+             n_pruned, len(store))
+    metrics.count('pruned_users', n_pruned)
+
+    # Sort the entries by row, and by descending risk in each row. The sort
+    # is stable, so that ties keep the order of the entries.
+    risk = store.counts[entries] / gcnt[store.tids[entries]]
+    order = np.lexsort((-risk, rows))
+    order = order[risk[order] >= p]
+    rows = rows[order]
+    if top_k is not None:
+        rank = np.arange(len(order)) - np.searchsorted(rows, rows)
+        order, rows = order[rank < top_k], rows[rank < top_k]
+    tids = store.tids[entries[order]].tolist()
+    starts = np.flatnonzero(np.diff(rows, prepend=-1)).tolist()
+    trajectories = store.trajectories
+    return {store.uids[row]: [trajectories[tid] for tid in tids[start:end]]
+            for row, start, end in zip(rows[starts].tolist(), starts,
+                                       starts[1:] + [len(tids)])}
+
+
+class StrongRelations(object):
+    """ Strong relations stored as groups of the users sharing a riskest
+    trajectory. Every two users of a group are strongly related, so a
+    group of k users takes O(k) memory rather than k * (k - 1) relations.
+    """
+    def __init__(self, groups: Iterable[Tuple[Trajectory, List[int]]] = ()):
+        self.trajectories = []  # Group -> riskest trajectory
+        self.members = []       # Group -> sorted UIDs
+        self.t2group = {}       # Riskest trajectory -> group
+        self.uid2group = {}     # UID -> group
+        for t, uids in groups:
+            g = len(self.members)
+            self.trajectories += t,
+            self.members += sorted(uids),
+            self.t2group[t] = g
+            for uid in uids:
+                self.uid2group[uid] = g
+
+    def related(self, uid: int) -> List[int]:
+        """ The users strongly related to the user. """
+        g = self.uid2group.get(uid)
+        if g is None:
+            return []
+        members = self.members[g]
+        i = bisect.bisect_left(members, uid)
+        return members[:i] + members[i + 1:]
+
+    def subset(self, uids: Iterable[int]) -> 'StrongRelations':
+        """ The groups of the given users, which must hold whole groups. """
+        groups = sorted({self.uid2group[uid] for uid in uids
+                         if uid in self.uid2group})
+        return StrongRelations((self.trajectories[g], self.members[g])
+                               for g in groups)
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __repr__(self) -> str:
+        return '<StrongRelations groups:{} users:{}>'.format(
+                len(self.members), len(self.uid2group))
 
 
 def _find_strong_relations(
         riskest: Dict[int, Trajectory]
-        ) -> Dict[int, List[int]]:
+        ) -> StrongRelations:
     """ Finds the strong relationships.
     """
-    t2uid = defaultdict(set)
+    t2uid = defaultdict(list)
     for uid, t in riskest.items():
-        t2uid[t].add(uid)
-    relations = defaultdict(list)
-    for t, uids in t2uid.items():
-        if len(uids) > 1:
-            for uid in uids:
-                relations[uid] = list(uids - set([uid]))
-    return relations
+        t2uid[t] += uid,
+    return StrongRelations((t, uids) for t, uids in t2uid.items()
+                           if len(uids) > 1)
 
 
 def _find_weak_relations(
         riskest: Dict[int, Trajectory],
-        itds: Dict[int, ITD],
-        strong_relations: Dict[int, List[int]]
-        ) -> Tuple[Dict[int, List[int]], Dict[int, List[int]]]:
-    """ Finds the weak relationships.
+        itds: Population,
+        strong_relations: Optional[StrongRelations] = None
+        ) -> Dict[int, List[int]]:
+    """ Finds the weak relationships, i.e. the other users owning the
+        riskest trajectory of a user without being strongly related.
     """
-    if not strong_relations:
+    if strong_relations is None:
         strong_relations = _find_strong_relations(riskest)
+    uid2group = strong_relations.uid2group
+    # The users of a group share their weakly related users, which are
+    # found once per group and shared by reference.
+    group_weak = {}
     weak = defaultdict(list)
-    for uid1, itd1 in itds.items():
-        for uid2, itd2 in itds.items():
-            if (uid1 != uid2
-                    and uid1 in riskest
-                    and riskest[uid1] in itds[uid2].trajectories
-                    and uid2 not in strong_relations[uid1]):
-                weak[uid1] += uid2,
+    for uid1 in riskest:
+        group = uid2group.get(uid1)
+        if group is None:
+            uids = [uid2 for uid2 in sorted(itds.users(riskest[uid1]))
+                    if uid2 != uid1]
+        else:
+            if group not in group_weak:
+                group_weak[group] = [
+                        uid2 for uid2 in sorted(itds.users(riskest[uid1]))
+                        if uid2group.get(uid2) != group]
+            uids = group_weak[group]
+        if uids:
+            weak[uid1] = uids
     return weak
 
 
-def _affected_by(
-        riskest: Dict[int, Trajectory],
-        itds: Dict[int, ITD],
-        ) -> Dict[int, List[int]]:
+class _Affected(Mapping[int, List[int]]):
     """ Lists affected users when one user's privacy parameter changes.
+    The list of a user is built on access, so that the strong groups are
+    not expanded into pairs. A user without relations only affects itself.
+    """
+    def __init__(self,
+                 uids: Collection[int],
+                 strong: StrongRelations,
+                 weak: Dict[int, List[int]]):
+        self._uids = uids
+        self._strong = strong
+        self._weak_in = defaultdict(list)
+        for k, v_list in weak.items():
+            for v in v_list:
+                self._weak_in[v] += k,
+
+    def __getitem__(self, uid: int) -> List[int]:
+        if uid not in self._uids:
+            raise KeyError(uid)
+        return [uid] + self._strong.related(uid) + self._weak_in.get(uid, [])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._uids)
+
+    def __len__(self) -> int:
+        return len(self._uids)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class RelationGraph(object):
+    """ Strong and weak relations between users for a riskest mapping. The
+    graph holds the users of riskest and the users weakly related to them;
+    every other user of the population has no relations.
     """
-    affected = {uid: [uid] for uid in itds}
+    def __init__(self, itds: Population, riskest: Dict[int, Trajectory]):
+        self.itds = itds
+        self.strong = _find_strong_relations(riskest)
+        self.weak = _find_weak_relations(riskest, itds, self.strong)
+        uids = set(riskest)
+        for v_list in self.weak.values():
+            uids.update(v_list)
+        self.uids = sorted(uids)
+        self._affected = None
+        self._components = self._component_of = None
 
-    strong_relations = _find_strong_relations(riskest)
-    for k, v_list in strong_relations.items():
-        for v in v_list:
-            affected[v] += k,
+    def subgraph(self, uids: List[int]) -> 'RelationGraph':
+        """ The relations among the given users, which must be a union of
+        connected components.
+        """
+        graph = RelationGraph.__new__(RelationGraph)
+        graph.itds = None
+        graph.uids = sorted(uids)
+        graph.strong = self.strong.subset(uids)
+        graph.weak = defaultdict(list, ((uid, self.weak[uid])
+                                        for uid in uids if uid in self.weak))
+        graph._affected = graph._components = graph._component_of = None
+        return graph
 
-    weak_relations = _find_weak_relations(riskest, itds, strong_relations)
-    for k, v_list in weak_relations.items():
-        for v in v_list:
-            affected[v] += k,
+    def structure(self, uids: List[int]) -> Tuple:
+        """ A hashable form of the relations of the given users, which must
+        be a union of connected components.
+        """
+        uid2group = self.strong.uid2group
+        groups = {uid2group[uid] for uid in uids if uid in uid2group}
+        return (tuple(sorted(tuple(self.strong.members[g]) for g in groups)),
+                tuple((uid, tuple(self.weak[uid])) for uid in uids
+                      if uid in self.weak))
+
+    def components(self) -> List[List[int]]:
+        """ Connected components of the strong and weak relations, found by
+        union-find. Users are listed in UID order in each component.
+        """
+        if self._components is None:
+            parent = {uid: uid for uid in self.uids}
+
+            def find(uid):
+                while parent[uid] != uid:
+                    parent[uid] = parent[parent[uid]]
+                    uid = parent[uid]
+                return uid
+
+            def union(k, v):
+                root_k, root_v = find(k), find(v)
+                if root_k != root_v:
+                    parent[root_k] = root_v
+
+            for members in self.strong.members:
+                for k, v in zip(members, members[1:]):
+                    union(k, v)
+            for k, v_list in self.weak.items():
+                for v in v_list:
+                    union(k, v)
+            groups = defaultdict(list)
+            for uid in self.uids:
+                groups[find(uid)] += uid,
+            self._components = list(groups.values())
+            self._component_of = {uid: comp for comp in self._components
+                                  for uid in comp}
+        return self._components
+
+    def component_of(self, uid: int) -> List[int]:
+        """ The connected component containing the user, which is the user
+        alone for a user of the population outside the graph.
+        """
+        self.components()
+        if uid in self._component_of:
+            return self._component_of[uid]
+        if self.itds is not None and uid not in self.itds:
+            raise KeyError(uid)
+        return [uid]
+
+    @property
+    def affected(self) -> Mapping[int, List[int]]:
+        """ Lists affected users when one user's privacy parameter changes.
+        """
+        if self._affected is None:
+            users = (self.itds if self.itds is not None
+                     else dict.fromkeys(self.uids))
+            self._affected = _Affected(users, self.strong, self.weak)
+        return self._affected
+
+
+class RelationCache(object):
+    """ A bounded LRU cache of relation graphs, keyed by the population and
+    the riskest mapping.
+    """
+    def __init__(self, maxsize: int = 32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._graphs = OrderedDict()
 
-    return affected
+    def get(self,
+            itds: Population,
+            riskest: Dict[int, Trajectory]
+            ) -> RelationGraph:
+        # Cached graphs hold a reference to their population, so its id
+        # cannot be reused while the entry is alive.
+        key = (id(itds), frozenset(riskest.items()))
+        if key in self._graphs:
+            self.hits += 1
+            self._graphs.move_to_end(key)
+            return self._graphs[key]
+        self.misses += 1
+        graph = self._graphs[key] = RelationGraph(itds, riskest)
+        if len(self._graphs) > self.maxsize:
+            self._graphs.popitem(last=False)
+        return graph
+
+    def __repr__(self) -> str:
+        return '<RelationCache size:{}/{} hits:{} misses:{}>'.format(
+                len(self._graphs), self.maxsize, self.hits, self.misses)
+
+
+def _relation_graph(
+        itds: Population,
+        riskest: Dict[int, Trajectory],
+        cache: Optional[RelationCache] = None
+        ) -> RelationGraph:
+    return cache.get(itds, riskest) if cache else RelationGraph(itds, riskest)
+
+
+def _affected_by(
+        riskest: Dict[int, Trajectory],
+        itds: Dict[int, ITD],
+        graph: Optional[RelationGraph] = None,
+        uid: Optional[int] = None
+        ) -> Mapping[int, List[int]]:
+    """ Lists affected users when one user's privacy parameter changes.
+        Given a uid, only the users in its connected component are listed.
+    """
+    if graph is None:
+        graph = RelationGraph(Population.of(itds), riskest)
+    if uid is not None:
+        return graph.subgraph(graph.component_of(uid)).affected
+    return graph.affected
 
 
 def _format_matrix(mat: List[List[float]]) -> List[str]:
@@ -88,27 +343,20 @@ def _format_matrix(mat: List[List[float]]) -> List[str]:
     return ["[%s]" % ", " .join(format_val(val) for val in row) for row in mat]
 
 
-def compute_CIDP(
-        itds: Dict[int, ITD],            # A mapping from UID to ITD
-        riskest: Dict[int, Trajectory],  # A mapping from UID to trajectory
-        epsl: Dict[int, float],          # A mapping from UID to epsilon
-        theta: float = 0.25              # Weak correlation coefficient
+def _CIDP_dense(
+        graph: RelationGraph,
+        epsl: Dict[int, float],
+        theta: float
     ) -> Dict[int, float]:
-    """ Correlated individual differencial privacy.
+    """ Computes CIDP with L and R as dense n x n matrices.
     """
-    log.debug("Computing CIDP(epsilon={}, theta={})".format(epsl, theta))
-
-    strong_relations = _find_strong_relations(riskest)
-    weak_relations = _find_weak_relations(riskest, itds, strong_relations)
-
-    #log.debug("strong relations: " + str(strong_relations))
-    #log.debug("weak relations: " + str(weak_relations))
-
+    strong_relations, weak_relations = graph.strong, graph.weak
+    uids = graph.uids
     # Note i, j are indices starts from 0. Indices are assigned to
     # users in an order sorted by their UID.
-    idx2uid = {i: uid for i, uid in enumerate(sorted(itds.keys()))}
-    uid2idx = {uid: i for i, uid in enumerate(sorted(itds.keys()))}
-    n = len(itds)
+    idx2uid = {i: uid for i, uid in enumerate(uids)}
+    uid2idx = {uid: i for i, uid in enumerate(uids)}
+    n = len(uids)
 
     # Let mat_R[i][j] = -epsl_i when i and j are not related. This does
     # not affect the computation result
@@ -118,7 +366,7 @@ def compute_CIDP(
     # Let L[i][i] = #connections
     # Let L[i][j] = L[j][i] = -1 if related
     for i in range(n):
-        for uid_j in strong_relations[idx2uid[i]]:
+        for uid_j in strong_relations.related(idx2uid[i]):
             j = uid2idx[uid_j]
             #log.debug("{} <-> {}".format(i, j))
             mat_L[i][i] += 0.5
@@ -126,7 +374,7 @@ def compute_CIDP(
             mat_L[i][j] = mat_L[j][i] = -1
             mat_R[i][j] = - epsl[idx2uid[i]]
             mat_R[j][i] = - epsl[idx2uid[j]]
-        for uid_j in weak_relations[idx2uid[i]]:
+        for uid_j in weak_relations.get(idx2uid[i], ()):
             j = uid2idx[uid_j]
             #log.debug("{} --> {}".format(i, j))
             mat_L[i][i] += 1
@@ -145,115 +393,640 @@ def compute_CIDP(
             mat_R[i][i] = 0
 
 
-    log.debug("L = " + "\n    ".join(_format_matrix(mat_L)))
-    log.debug("R = " + "\n    ".join(_format_matrix(mat_R)))
+    log.debug("L = %s", Lazy(lambda: "\n    ".join(_format_matrix(mat_L))))
+    log.debug("R = %s", Lazy(lambda: "\n    ".join(_format_matrix(mat_R))))
 
-    cidp = {idx2uid[i]: sum(mat_L[i][j] * mat_R[j][i] for j in range(n))
+    return {idx2uid[i]: sum(mat_L[i][j] * mat_R[j][i] for j in range(n))
             for i in range(n)}
-    log.debug(f"CIDP = {cidp}")
+
+
+# Kinds of the entries of the product L[i][j] * R[j][i]
+_STRONG, _WEAK, _ZERO, _DIAG = range(4)
+
+# Strong groups of up to this many users are stored as entries, and their
+# CIDP is summed in the same order as in _CIDP_dense. Larger groups keep a
+# sum of epsilons, which saves memory quadratic in the group size but may
+# differ from _CIDP_dense in the last bits.
+MAX_EXPANDED_GROUP = 128
+
+
+class CIDPEvaluator(object):
+    """ Evaluates CIDP for fixed relations with L and R stored sparsely.
+
+    The relations, L and the kind of each entry of R are built once. The
+    strong entries of a user in a group larger than MAX_EXPANDED_GROUP add
+    up to the sum of the epsilons of the other users in its group, so only
+    a sum per group is kept for them. When the epsilons of some users
+    change, only the CIDP of the users related to them and the sums of
+    their groups are recomputed.
+    """
+    def __init__(self,
+                 graph: RelationGraph,
+                 epsl: Dict[int, float],
+                 theta: float = 0.25):
+        strong_relations, weak_relations = graph.strong, graph.weak
+        self._uids = list(graph.uids)
+        self._uid2idx = {uid: i for i, uid in enumerate(self._uids)}
+        self._uid_array = np.array(self._uids)
+        self._theta = theta
+        n = len(self._uids)
+
+        # A user of a group of k users has k - 1 strong relations, which
+        # add 0.5 to L[i][i] from either end. R[i][j] = -epsl[i] for every
+        # pair of a group.
+        diag = np.zeros(n)
+        self._group = np.full(n, -1)
+        self._members = []
+        strong = [np.empty((0, 2), np.int64)]
+        for uids in strong_relations.members:
+            idx = np.array([self._uid2idx[uid] for uid in uids])
+            diag[idx] += len(idx) - 1
+            if len(idx) <= MAX_EXPANDED_GROUP:
+                i, j = np.meshgrid(idx, idx, indexing='ij')
+                strong += np.stack([i[i != j], j[i != j]], axis=1),
+            else:
+                self._group[idx] = len(self._members)
+                self._members += idx,
+        strong = np.concatenate(strong)
+
+        # Kinds of the off-diagonal entries of R of weak relations keyed by
+        # (i, j), which are never strongly related. They are written in the
+        # same order as in _CIDP_dense, so that later writes win the same
+        # way. L[i][j] = -1 for every key.
+        off_R = {}
+        for i, uid in enumerate(self._uids):
+            for uid_j in weak_relations.get(uid, ()):
+                j = self._uid2idx[uid_j]
+                diag[i] += 1
+                diag[j] += 1
+                off_R[i, j] = _WEAK
+                off_R[j, i] = _ZERO
+
+        # Entries of L[i][j] * R[j][i] in CSR order. The kind of entry
+        # (i, j) is the kind of R[j][i].
+        d_idx = np.flatnonzero(diag)
+        off_idx = np.concatenate([
+                strong,
+                np.array(list(off_R.keys()), dtype=np.int64).reshape(-1, 2)])
+        rows = np.concatenate([off_idx[:, 1], d_idx])
+        cols = np.concatenate([off_idx[:, 0], d_idx])
+        kind = np.concatenate([np.full(len(strong), _STRONG, np.int8),
+                               np.fromiter(off_R.values(), np.int8, len(off_R)),
+                               np.full(len(d_idx), _DIAG, np.int8)])
+        lval = np.concatenate([np.full(len(off_idx), -1.0), diag[d_idx]])
+        order = np.lexsort((cols, rows))
+        self._indices = cols[order]
+        self._kind = kind[order]
+        self._lval = lval[order]
+        self._indptr = np.concatenate(
+                [[0], np.cumsum(np.bincount(rows, minlength=n))])
+        self._ones = np.ones(n)
+
+        self._e = np.array([epsl[uid] for uid in self._uids], dtype=float)
+        # Sums of epsilons per group, with a trailing 0 for group -1
+        self._gsum = np.array([self._e[idx].sum() for idx in self._members]
+                              + [0.0])
+        self._part = self._rows_cidp(np.arange(n))
+        metrics.count('cidp_builds')
+        metrics.count('cidp_nnz', len(self._indices) + n)
+
+    def _positions(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Positions of the entries of the given rows, and the CSR row
+            pointers of the entries taken in that order.
+        """
+        lens = self._indptr[rows + 1] - self._indptr[rows]
+        indptr = np.concatenate([[0], np.cumsum(lens)])
+        pos = (np.repeat(self._indptr[rows] - indptr[:-1], lens)
+               + np.arange(indptr[-1]))
+        return pos, indptr
+
+    def _rows_cidp(self, rows: np.ndarray) -> np.ndarray:
+        """ sum_j L[i][j] * R[j][i] over the stored entries for the given
+            rows, summed in the order of j.
+        """
+        pos, indptr = self._positions(rows)
+        kind, lval = self._kind[pos], self._lval[pos]
+        e = self._e[self._indices[pos]]
+        mat_R = np.where(kind == _STRONG, -e,
+                np.where(kind == _WEAK, -e * self._theta,
+                np.where(kind == _DIAG, e / lval, 0.0)))
+        prod = sp.csr_matrix((lval * mat_R, self._indices[pos], indptr),
+                             shape=(len(rows), len(self._uids)))
+        return prod @ self._ones
+
+    def __getitem__(self, uid: int) -> float:
+        i = self._uid2idx[uid]
+        g = self._group[i]
+        if g < 0:
+            return float(self._part[i])
+        return float(self._part[i] + (self._gsum[g] - self._e[i]))
+
+    def epsilon(self, uid: int) -> float:
+        return float(self._e[self._uid2idx[uid]])
+
+    def epsilons(self) -> Dict[int, float]:
+        return dict(zip(self._uids, self._e.tolist()))
+
+    def cidp(self) -> Dict[int, float]:
+        strong = np.where(self._group >= 0,
+                          self._gsum[self._group] - self._e, 0.0)
+        return dict(zip(self._uids, (self._part + strong).tolist()))
+
+    def _index(self, uids: Sequence[int]) -> np.ndarray:
+        # The UIDs of a relation graph are sorted. Arrays of UIDs are
+        # looked up much faster than lists.
+        uids = np.asarray(uids)
+        idx = np.searchsorted(self._uid_array, uids)
+        found = idx < len(self._uids)
+        found[found] = self._uid_array[idx[found]] == uids[found]
+        if not found.all():
+            raise KeyError(uids[np.argmin(found)].item())
+        return idx
+
+    def get(self, uids: List[int]) -> np.ndarray:
+        """ The epsilons of the given users. """
+        return self._e[self._index(uids)]
+
+    def set(self, uids: List[int], values: Sequence[float]):
+        """ Sets the epsilons of the given distinct users. """
+        idx = self._index(uids)
+        self._e[idx] = values
+        self._refresh(idx)
+
+    def shift(self, uids: List[int], delta: float):
+        """ Adds delta to the epsilon of each listed distinct user. """
+        idx = self._index(uids)
+        self._e[idx] += delta
+        self._refresh(idx)
+
+    def update(self, epsl: Dict[int, float]):
+        """ Sets the epsilons of the given users. """
+        self.set(list(epsl), list(epsl.values()))
+
+    def _refresh(self, idx: np.ndarray):
+        # L is symmetric in structure, so the users whose CIDP depends on
+        # user k through a stored entry are the columns of row k.
+        rows = np.sort(self._indices[self._positions(idx)[0]])
+        rows = rows[np.concatenate([[True], rows[1:] != rows[:-1]])]
+        if len(rows):
+            self._part[rows] = self._rows_cidp(rows)
+        for g in set(self._group[idx].tolist()) - {-1}:
+            self._gsum[g] = self._e[self._members[g]].sum()
+        metrics.count('cidp_evals')
+        metrics.count('cidp_rows', len(rows))
+
+
+def _CIDP_sparse(
+        graph: RelationGraph,
+        epsl: Dict[int, float],
+        theta: float
+    ) -> Dict[int, float]:
+    """ Computes CIDP as _CIDP_dense does, but only stores the nonzero
+        entries of L and R, except for strong groups larger than
+        MAX_EXPANDED_GROUP, of which only the sums of epsilons are kept.
+        See CIDPEvaluator.
+    """
+    return CIDPEvaluator(graph, epsl, theta).cidp()
+
+
+_CIDP_BACKENDS = {
+    'dense': _CIDP_dense,
+    'sparse': _CIDP_sparse,
+}
+
+
+def compute_CIDP(
+        itds: Dict[int, ITD],            # A mapping from UID to ITD
+        riskest: Dict[int, Trajectory],  # A mapping from UID to trajectory
+        epsl: Dict[int, float],          # A mapping from UID to epsilon
+        theta: float = 0.25,             # Weak correlation coefficient
+        backend: str = 'sparse',         # One of 'sparse' and 'dense'
+        graph: Optional[RelationGraph] = None, # Relations of riskest
+        cache: Optional[MutableMapping] = None # Results per component
+    ) -> Dict[int, float]:
+    """ Correlated individual differencial privacy.
+
+    CIDP is computed on each connected component of the relations on its
+    own, as users in different components do not interact. Users without
+    relations have a CIDP of 0. With a cache, the results of a component
+    are reused while its relations and epsilons are unchanged.
+    """
+    log.debug("Computing CIDP(epsilon=%s, theta=%s)", epsl, theta)
+    if backend not in _CIDP_BACKENDS:
+        raise ValueError("Unknown CIDP backend: {}".format(backend))
+    if graph is None:
+        graph = RelationGraph(Population.of(itds), riskest)
+
+    #log.debug("strong relations: " + str(graph.strong))
+    #log.debug("weak relations: " + str(graph.weak))
+
+    with metrics.phase('cidp', len(graph.uids)):
+        cidp = {uid: 0.0 for uid in sorted(itds)}
+        for uids in graph.components():
+            if len(uids) < 2:
+                continue
+            key = (backend, theta, graph.structure(uids),
+                   tuple(epsl[u] for u in uids))
+            if cache is not None and key in cache:
+                cidp.update(zip(uids, cache[key]))
+                metrics.count('cidp_cache_hits')
+                continue
+            part = _CIDP_BACKENDS[backend](graph.subgraph(uids), epsl, theta)
+            cidp.update(part)
+            if cache is not None:
+                cache[key] = tuple(part[u] for u in uids)
+    log.debug("CIDP = %s", cidp)
     return cidp
 
 
+def _out_of_time(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.time() > deadline
+
+
+def _step_crossing(
+        evaluator: CIDPEvaluator,
+        uid: int,
+        users: List[int],
+        beta: float,
+        max_iter: int,
+        deadline: Optional[float]
+    ) -> Tuple[int, bool]:
+    """ Moves the epsilons of the given users by beta until the CIDP of uid
+        crosses 1. Gives up when a step does not move the CIDP towards 1,
+        when it drives an epsilon to 0 or below, or when the iteration or
+        time budget runs out. Returns the number of steps and whether the
+        CIDP crossed 1.
+    """
+    up = evaluator[uid] <= 1
+    for i in range(1, max_iter + 1):
+        before = evaluator[uid]
+        evaluator.shift(users, beta if up else -beta)
+        after = evaluator[uid]
+        if not up and evaluator.get(users).min() <= 0:
+            log.debug("IDFA of user %s drives an epsilon to 0", uid)
+            return i, False
+        if (after > 1) if up else (after <= 1):
+            return i, True
+        if (after <= before) if up else (after >= before):
+            log.debug("CIDP of user %s moves away from 1", uid)
+            return i, False
+        if _out_of_time(deadline):
+            return i, False
+    return max_iter, False
+
+
+def _solve_crossing(
+        evaluator: CIDPEvaluator,
+        uid: int,
+        users: List[int],
+        beta: float,
+        tol: float,
+        max_iter: int,
+        deadline: Optional[float]
+    ) -> Tuple[int, bool]:
+    """ Shifts the epsilons of the given users by a common offset so that
+        the CIDP of uid reaches 1 within tol, using the secant method. CIDP
+        is linear in epsilon for fixed relations, so this usually takes one
+        secant step after the initial probe of size beta. Gives up when an
+        iterate drives an epsilon to 0 or below. Returns the number of
+        evaluations and whether it converged.
+    """
+    base = evaluator.get(users)
+    t0, f0 = 0.0, evaluator[uid] - 1
+    t1 = beta if f0 < 0 else -beta
+    for i in range(1, max_iter + 1):
+        if base.min() + t1 <= 0:
+            log.debug("IDFA of user %s drives an epsilon to 0", uid)
+            return i, False
+        evaluator.set(users, base + t1)
+        f1 = evaluator[uid] - 1
+        if abs(f1) <= tol:
+            return i, True
+        if f1 == f0 or not np.isfinite(f1):
+            log.debug("CIDP of user %s does not move with epsilon", uid)
+            return i, False
+        if _out_of_time(deadline):
+            return i, False
+        t0, f0, t1 = t1, f1, t1 - f1 * (t1 - t0) / (f1 - f0)
+    return max_iter, False
+
+
+class IDFAResult(NamedTuple):
+    """ Result of compute_IDFA. The iterations and convergence are listed
+    for the users that needed optimizing.
+    """
+    epsl: Dict[int, float]       # Optimized epsilon of every user
+    iterations: Dict[int, int]   # Steps or evaluations used per user
+    converged: Dict[int, bool]   # Whether the CIDP of the user crossed 1
+
+
+def _optimize(
+        cidp: CIDPEvaluator,
+        uids: List[int],
+        affected: Dict[int, List[int]],
+        beta: float,
+        method: str,
+        tol: float,
+        max_iter: int,
+        deadline: Optional[float]
+        ) -> Tuple[Dict[int, int], Dict[int, bool]]:
+    """ Optimizes the epsilons of the given users in order. When a user
+        does not converge, the epsilons it moved are restored.
+    """
+    iterations, converged = {}, {}
+    for uid in uids:
+        if cidp[uid] <= cidp.epsilon(uid):
+            continue
+
+        if _out_of_time(deadline):
+            iterations[uid], converged[uid] = 0, False
+            continue
+
+        log.debug("Optimizing user %s...", uid)
+        users = np.array(affected[uid])
+        base = cidp.get(users)
+        if method == 'secant':
+            n, ok = _solve_crossing(cidp, uid, users, beta, tol, max_iter,
+                                    deadline)
+        else:
+            n, ok = _step_crossing(cidp, uid, users, beta, max_iter,
+                                   deadline)
+        if not ok:
+            log.debug("IDFA of user %s did not converge in %d iterations",
+                      uid, n)
+            cidp.set(users, base)
+        iterations[uid], converged[uid] = n, ok
+    return iterations, converged
+
+
+def _optimize_component(args) -> Tuple[IDFAResult, Dict[str, int]]:
+    """ Optimizes the users of one connected component in a worker process.
+        The metrics counters of the worker are returned with the result.
+    """
+    (graph, uids, epsl_init, beta, method, tol, max_iter, deadline,
+     enabled) = args
+    metrics.enabled = enabled
+    metrics.reset()
+    cidp = CIDPEvaluator(graph, {uid: epsl_init for uid in graph.uids})
+    iterations, converged = _optimize(cidp, uids, graph.affected, beta,
+                                      method, tol, max_iter, deadline)
+    return (IDFAResult(cidp.epsilons(), iterations, converged),
+            metrics.report(rounds=False)['counters'])
+
+
+def _IDFA(
+        itds: Population,
+        graph: RelationGraph,
+        epsl_init: float = 0.1,
+        beta: float = 0.05,
+        method: str = 'step',
+        tol: float = 1e-9,
+        workers: int = 1,
+        max_iter: int = 10000,
+        deadline: Optional[float] = None,
+        pool: Optional[ProcessPoolExecutor] = None
+        ) -> IDFAResult:
+    """ Runs IDFA on the users of the relation graph, which are optimized
+        in the order of itds. With workers > 1, the components run in pool,
+        or in a new pool if none is given. See compute_IDFA.
+    """
+    log.info("Computing IDFA(esplion_init=%s, beta=%s, method=%s)",
+             epsl_init, beta, method)
+    store = itds.store
+    if workers > 1:
+        # Users without relations are never optimized.
+        tasks = [(graph.subgraph(uids), sorted(uids, key=store.row),
+                  epsl_init, beta, method, tol, max_iter, deadline,
+                  metrics.enabled)
+                 for uids in graph.components() if len(uids) > 1]
+        epsl = {uid: epsl_init for uid in graph.uids}
+        iterations, converged = {}, {}
+        with (ProcessPoolExecutor(max_workers=workers) if pool is None
+              else nullcontext(pool)) as executor:
+            for part, counters in executor.map(
+                    _optimize_component, tasks,
+                    chunksize=max(1, len(tasks) // workers // 4)):
+                epsl.update(part.epsl)
+                iterations.update(part.iterations)
+                converged.update(part.converged)
+                for name, n in counters.items():
+                    metrics.count(name, n)
+    else:
+        cidp = CIDPEvaluator(graph, {uid: epsl_init for uid in graph.uids})
+        affected = graph.affected
+        log.debug("affected = %s", affected)
+        iterations, converged = _optimize(
+                cidp, sorted(graph.uids, key=store.row), affected, beta,
+                method, tol, max_iter, deadline)
+        epsl = cidp.epsilons()
+
+    if not all(converged.values()):
+        log.warning("IDFA did not converge for %d of %d users",
+                    list(converged.values()).count(False), len(converged))
+    metrics.count('idfa_iterations', sum(iterations.values()))
+    return IDFAResult(epsl, iterations, converged)
+
+
 def compute_IDFA(
         itds: Dict[int, ITD],            # A mapping from UID to ITD
         riskest: Dict[int, Trajectory],  # A mapping from UID to trajectory
         epsl_init: float = 0.1,          # Initial privacy parameter
-        beta: float = 0.05               # Step parameter
-        ):
+        beta: float = 0.05,              # Step parameter
+        method: str = 'step',            # One of 'step' and 'secant'
+        tol: float = 1e-9,               # Tolerance of |CIDP - 1| (secant)
+        graph: Optional[RelationGraph] = None,  # Relations of riskest
+        workers: int = 1,                # Number of processes
+        max_iter: int = 10000,           # Maximum iterations per user
+        time_budget: Optional[float] = None  # Seconds for the whole call
+        ) -> IDFAResult:
     """ Individual DF-optimization algorithm.
+
+    With method='step', the epsilons of the affected users are moved by
+    beta until the CIDP of the user crosses 1. With method='secant', the
+    crossing point is solved directly by _solve_crossing. A user whose
+    CIDP moves away from 1, whose optimization drives an epsilon to 0 or
+    below, or who does not cross 1 within max_iter iterations, is reported
+    as not converged and keeps its epsilons. Once
+    time_budget runs out, the remaining users are not optimized.
+
+    Users in different connected components of the relations do not
+    affect each other's CIDP. With workers > 1, the components are
+    optimized concurrently in a process pool, which gives the same result
+    as the serial run.
     """
-    log.info(f"Computing IDFA(esplion_init={epsl_init}, beta={beta})")
+    if method not in ('step', 'secant'):
+        raise ValueError("Unknown IDFA method: {}".format(method))
+    itds = Population.of(itds)
+    if graph is None:
+        graph = RelationGraph(itds, riskest)
+    deadline = None if time_budget is None else time.time() + time_budget
+
+    result = _IDFA(itds, graph, epsl_init, beta, method, tol, workers,
+                   max_iter, deadline)
     epsl = {uid: epsl_init for uid in itds}
-    cidp = compute_CIDP(itds, riskest, epsl)
+    epsl.update(result.epsl)
+    log.debug("epsl_opt = %s", epsl)
+    return result._replace(epsl=epsl)
 
-    affected = _affected_by(riskest, itds)
-    log.debug(f"affected = {affected}")
 
-    for uid in itds:
-        if cidp[uid] <= epsl[uid]:
-            continue
+def _reduce_risk(
+        itds: Population,
+        riskest: Dict[int, Trajectory],
+        p: float
+        ) -> Dict[int, int]:
+    """ Computes, for each user in riskest, the amount delta_f by which
+        the count of its riskest trajectory must be reduced so that the
+        risk drops below p, i.e. the true count minus the largest count
+        cnt <= count with cnt / global_count < p.
+    """
+    store = itds.store
+    uids = list(riskest)
+    cnt = store.counts[[store.entry(store.row(uid), t)
+                        for uid, t in riskest.items()]]
+    total = itds.gcnt[[store.tid(t) for t in riskest.values()]]
+
+    # The largest integer k with k / total < p is ceil(p * total) - 1, up
+    # to the rounding of p * total, which is corrected against the same
+    # division as _risk.
+    k = np.ceil(p * total).astype(np.int64) - 1
+    k -= k / total >= p
+    k += (k + 1) / total < p
+    delta = np.where(cnt / total < p, 0, cnt - k)
+    return dict(zip(uids, delta.tolist()))
+
+
+def _laplace_noise(
+        streams: List[np.random.Generator],
+        shard: np.ndarray,
+        scale: np.ndarray,
+        workers: int = 1
+        ) -> np.ndarray:
+    """ Draws Laplace noise of the given scales, where the noise of shard s
+        is drawn from streams[s]. Shards are drawn by up to workers threads.
+    """
+    noise = np.empty(len(scale))
 
-        log.info(f"Optimizing user {uid}...")
-        if epsl[uid] < cidp[uid] <= 1:
-            while True:
-                for uid_ in affected[uid]:
-                    epsl[uid_] += beta
-                cidp = compute_CIDP(itds, riskest, epsl)
-                if cidp[uid] > 1:
-                    break
-        elif cidp[uid] > 1:
-            while True:
-                for uid_ in affected[uid]:
-                    epsl[uid_] -= beta
-                cidp = compute_CIDP(itds, riskest, epsl)
-                if cidp[uid] <= 1:
-                    break
-
-    log.debug(f"epsl_opt = {epsl}")
-    return epsl
+    def draw(s):
+        idx = np.flatnonzero(shard == s)
+        noise[idx] = streams[s].laplace(0, scale[idx])
+
+    if workers > 1 and len(streams) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(draw, range(len(streams))))
+    else:
+        for s in range(len(streams)):
+            draw(s)
+    return noise
 
 
 def sanitize(
         itds: Dict[int, ITD],
         p :float = 0.5,            # risk threshold
-        max_round :int = 1000      # maximum number of rounds
+        max_round :int = 1000,     # maximum number of rounds
+        relation_cache :Optional[RelationCache] = None,
+        seed :Optional[int] = None,# seed of the noise generator
+        workers :int = 1,          # number of processes for IDFA and
+                                   # threads for noise
+        top_k :Optional[int] = None,# risky trajectories kept per user
+        progress :Optional[Callable[[int, List[int]], None]] = None,
+        shards :int = 1,           # number of noise streams
+        beta :float = 0.05,        # step parameter of IDFA
+        method :str = 'step',      # 'step' or 'secant', see compute_IDFA
+        tol :float = 1e-9,         # tolerance of |CIDP - 1| (secant)
+        max_iter :int = 10000,     # maximum IDFA iterations per user
+        time_budget :Optional[float] = None # seconds of IDFA for the call
     ) -> Dict[int, Dict[Trajectory, float]]:
-    # Initialze noise count by true count
-    noise_count = {uid: {t: itd.count(t) for t in itd.trajectories}
-                   for uid, itd in itds.items()}
+    """ Sanitizes the ITDs. In each round, the riskest remaining risky
+    trajectory of every active user is sanitized, where the active users
+    are those with risky trajectories left. When given, progress is called
+    at the start of every round with the round number and the list of
+    active UIDs, which must not be modified.
+
+    The users are split into shards by their row in the trajectory store,
+    and each shard draws its noise from its own stream spawned from seed.
+    The noise of the shards is drawn concurrently, and only depends on
+    seed and shards, not on workers.
+
+    The IDFA of all rounds shares time_budget. Once it runs out, the users
+    left are sanitized with their initial epsilon, as compute_IDFA leaves
+    them.
+    """
+    if method not in ('step', 'secant'):
+        raise ValueError("Unknown IDFA method: {}".format(method))
+    itds = Population.of(itds)
+    streams = [np.random.default_rng(s)
+               for s in np.random.SeedSequence(seed).spawn(shards)]
+    metrics.reset()
+    deadline = None if time_budget is None else time.time() + time_budget
+
+    # Initialze noise count by true count. The noise counts are kept in
+    # one flat array laid out as the entries of the trajectory store.
+    store = itds.store
+    noise_count = store.counts.astype(float)
 
     # Identify risky trajectories of each user and sort them by they
-    # risk value in an ascending order.
-    risky = {}
-    for uid, itd in itds.items():
-        tv = [(t, _risk(itd.count(t), t, itds)) for t in itd.trajectories]
-        risky[uid] = [t for t, v in sorted(tv, key=lambda x: x[1], reverse=True)
-                      if v >= p]
-    log.debug(f"risky = {risky}")
-
-    for round_ in range(1, max_round):
-        log.info(f"Senitization iteration {round_}...")
-
-        # Find the riskest trajectories of each user
-        riskest = {uid: risky[uid].pop() for uid in itds if risky[uid]}
-        log.debug("riskest = {"
-                + "\n           ".join(f"{k}:{v}" for k, v in riskest.items())
-                + "}")
-
-        if not riskest:
-            break
-
-        # Sanitize risky trajectories
-        epsl_opt = compute_IDFA(itds, riskest)
-
-        delta_f = {uid: 0 for uid in itds}
-        for uid, itd in itds.items():
-            if uid in riskest:
-                # Reduce the risk dwon to threshold
-                cnt = itd.count(riskest[uid])
-                while True:
-                    v = _risk(cnt, riskest[uid], itds)
-                    if v < p: break
-                    cnt -= 1
-                delta_f[uid] = itd.count(riskest[uid]) - cnt
-        log.info(f"delta_f = {delta_f}")
-
-        # Add noisy to count
-        for uid, itd in itds.items():
-            if uid in riskest:
-                # Remove delta_f
-                noise_count[uid][riskest[uid]] -= delta_f[uid]
+    # risk value in a descending order.
+    with metrics.phase('risk', len(store.tids)):
+        risky = _find_risky(itds, p, top_k)
+    log.debug("risky = %s", risky)
+
+    # Users with risky trajectories left, in the order of itds
+    active = list(risky)
+
+    # One process pool serves the IDFA of every round
+    with metrics.rounds(), (ProcessPoolExecutor(max_workers=workers)
+                            if workers > 1 else nullcontext()) as pool:
+        for round_ in range(1, max_round):
+            log.info("Senitization iteration %d (%d active users)...",
+                     round_, len(active))
+            metrics.new_round(round_)
+            metrics.count('active_users', len(active))
+            if progress is not None:
+                progress(round_, active)
+
+            # Find the riskest trajectories of each user
+            riskest = {uid: risky[uid].pop() for uid in active}
+            active = [uid for uid in active if risky[uid]]
+            log.debug("riskest = {%s}", Lazy(lambda: "\n           ".join(
+                    f"{k}:{v}" for k, v in riskest.items())))
 
-                # Add laplace noise
-                for t in itd.trajectories:
-                    scale = delta_f[uid] / epsl_opt[uid]
-                    noise_count[uid][t] += np.random.laplace(0, scale, 1)
+            if not riskest:
+                break
+
+            # Sanitize risky trajectories
+            with metrics.phase('relations', len(riskest)):
+                graph = _relation_graph(itds, riskest, relation_cache)
+            if relation_cache:
+                log.debug("%s", relation_cache)
+            with metrics.phase('idfa', len(riskest)):
+                epsl_opt = _IDFA(itds, graph, beta=beta, method=method,
+                                 tol=tol, workers=workers, max_iter=max_iter,
+                                 deadline=deadline, pool=pool).epsl
+
+            with metrics.phase('delta_f', len(riskest)):
+                delta_f = _reduce_risk(itds, riskest, p)
+            log.debug("delta_f = %s", delta_f)
+
+            with metrics.phase('noise', len(riskest)):
+                # Remove delta_f
+                rows = np.array([store.row(uid) for uid in riskest])
+                for row, (uid, t) in zip(rows.tolist(), riskest.items()):
+                    noise_count[store.entry(row, t)] -= delta_f[uid]
 
-                # Convert to non-negative numbers
-                for t in itd.trajectories:
-                    if noise_count[uid][t] > 0:
-                        noise_count[uid][t] = noise_count[uid][t][0]
-                    else:
-                        noise_count[uid][t] = 0
+                # Add laplace noise to all the counts of the sanitized users
+                # and convert them to non-negative numbers
+                sizes = store.offsets[rows + 1] - store.offsets[rows]
+                # Concatenation of the entry ranges of the rows
+                slots = (np.repeat(store.offsets[rows] - np.cumsum(sizes)
+                                   + sizes, sizes)
+                         + np.arange(sizes.sum()))
+                scale = np.repeat([delta_f[uid] / epsl_opt[uid]
+                                   for uid in riskest], sizes)
+                noise = _laplace_noise(streams, np.repeat(rows % shards, sizes),
+                                       scale, workers)
+                noise_count[slots] = np.maximum(noise_count[slots] + noise, 0)
 
-    return noise_count
+    metrics.emit()
+    return {uid: dict(zip(itd.trajectories,
+                          noise_count[store.span(store.row(uid))].tolist()))
+            for uid, itd in itds.items()}
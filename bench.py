@@ -0,0 +1,191 @@
+""" Benchmarks of the public functions on synthetic populations.
+
+Usage:
+    python bench.py [--sizes 100 1000 10000] [--output bench.json]
+                    [--compare previous.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from typing import *
+
+import numpy as np
+
+import algo
+import data
+from log import log
+from metrics import metrics
+
+
+FUNCTIONS = ('load_ITDs', 'compute_CIDP', 'compute_IDFA', 'sanitize')
+
+
+def generate_trips(
+        n_users: int,
+        trajs_per_user: float = 5.0,   # Mean number of trips per user
+        length: Tuple[int, int] = (2, 6),  # Range of trajectory lengths
+        n_locations: int = 100,        # Number of distinct area codes
+        n_shared: int = 50,            # Number of commonly shared trajectories
+        overlap: float = 0.5,          # Chance a trip is a shared trajectory
+        skew: float = 1.0,             # Zipf exponent of shared trajectories
+        seed: int = 0
+        ) -> Iterator[Tuple[int, Tuple[int, ...]]]:
+    """ Generates (uid, locations) trips of a synthetic population. Each
+    user makes 1 + Poisson(trajs_per_user - 1) trips. A trip is one of
+    n_shared common trajectories with probability overlap, chosen with
+    Zipf-like popularity, and a random trajectory otherwise.
+    """
+    rng = np.random.default_rng(seed)
+
+    def random_trajectories(n):
+        lens = rng.integers(length[0], length[1] + 1, n)
+        locs = rng.integers(1, n_locations + 1, lens.sum()).tolist()
+        bounds = np.concatenate([[0], np.cumsum(lens)]).tolist()
+        return [tuple(locs[s:e]) for s, e in zip(bounds[:-1], bounds[1:])]
+
+    shared = random_trajectories(n_shared)
+    weights = 1 / np.arange(1, n_shared + 1) ** skew
+    weights /= weights.sum()
+
+    trips = 1 + rng.poisson(max(trajs_per_user - 1, 0), n_users)
+    n_trips = int(trips.sum())
+    is_shared = rng.random(n_trips) < overlap
+    picks = rng.choice(n_shared, n_trips, p=weights).tolist()
+    unique = iter(random_trajectories(int((~is_shared).sum())))
+    uids = np.repeat(np.arange(1, n_users + 1), trips).tolist()
+    for uid, s, pick in zip(uids, is_shared.tolist(), picks):
+        yield uid, shared[pick] if s else next(unique)
+
+
+def write_trips(path: str, trips: Iterable[Tuple[int, Tuple[int, ...]]]):
+    """ Writes trips in the format of data/selected.csv. """
+    with open(path, 'w') as f:
+        f.write('uid,date,traj_site,traj_arr\n')
+        for uid, locations in trips:
+            traj = '"({})"'.format(','.join(map(str, locations)))
+            f.write('{},0,{},{}\n'.format(uid, traj, traj))
+
+
+def _riskest(itds: data.Population, p: float) -> Dict[int, data.Trajectory]:
+    """ Picks the riskest trajectories of the first sanitize round, so that
+    the relations are those sanitize sees. A random trajectory per user
+    would relate most users through the popular shared trajectories.
+    """
+    return {uid: risky.pop()
+            for uid, risky in algo._find_risky(itds, p).items()}
+
+
+def _measure(fn: Callable[[], Any], memory: bool) -> Tuple[float, int]:
+    """ Returns the wall time of fn, and its peak traced memory when memory
+    is set. Memory is traced in a second run, so as not to slow the first.
+    """
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def run(sizes: List[int],
+        functions: List[str] = FUNCTIONS,
+        memory: bool = True,
+        seed: int = 0,
+        p: float = 0.5,
+        **gen_kwargs
+        ) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            path = os.path.join(tmp, 'trips_{}.csv'.format(n))
+            write_trips(path, generate_trips(n, seed=seed, **gen_kwargs))
+            itds = data.load_ITDs(path, workers=1)
+            riskest = _riskest(itds, p)
+            epsl = {uid: 0.1 for uid in itds}
+            cases = {
+                'load_ITDs': lambda: data.load_ITDs(path, workers=1),
+                'compute_CIDP': lambda: algo.compute_CIDP(itds, riskest, epsl),
+                'compute_IDFA': lambda: algo.compute_IDFA(itds, riskest),
+                'sanitize': lambda: algo.sanitize(itds, p, seed=seed),
+            }
+            for name in functions:
+                seconds, peak = _measure(cases[name], memory)
+                result = {
+                    'function': name,
+                    'users': n,
+                    'entries': len(itds.store.tids),
+                    'seconds': seconds,
+                    'users_per_second': n / seconds if seconds else None,
+                    'peak_bytes': peak,
+                }
+                print(json.dumps(result))
+                results.append(result)
+    return results
+
+
+def compare(results: List[Dict[str, Any]], previous: List[Dict[str, Any]]):
+    """ Prints the time ratio of each result to a previous run. """
+    before = {(r['function'], r['users']): r['seconds'] for r in previous}
+    for r in results:
+        key = (r['function'], r['users'])
+        if key in before and before[key]:
+            print('{:<14}{:>10}  x{:.2f}'.format(
+                    r['function'], r['users'], r['seconds'] / before[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS,
+                        default=list(FUNCTIONS))
+    parser.add_argument('--trajs-per-user', type=float, default=5.0)
+    parser.add_argument('--min-length', type=int, default=2)
+    parser.add_argument('--max-length', type=int, default=6)
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--p', type=float, default=0.5,
+                        help='risk threshold of sanitize')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip measuring peak memory')
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args()
+
+    # Users that do not converge are expected on synthetic data, and their
+    # warnings would interleave with the results on stdout.
+    log.setLevel(logging.ERROR)
+    metrics.enabled = False
+
+    results = run(args.sizes, args.functions,
+                  memory=not args.no_memory,
+                  seed=args.seed,
+                  p=args.p,
+                  trajs_per_user=args.trajs_per_user,
+                  length=(args.min_length, args.max_length),
+                  overlap=args.overlap,
+                  skew=args.skew)
+    with open(args.output, 'w') as f:
+        json.dump({'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'args': vars(args)},
+                   'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,31 @@
-from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor
 import collections
+import glob
+import hashlib
+import json
 import os
 import re
+import shutil
+import tempfile
+import weakref
 import yaml
 from typing import *
 
 import pandas as pd
 import numpy as np
 
-from log import log
+from log import Lazy, log
 
 
 PROJECT_ROOT = '.'
 DATA_PATH = os.path.join(PROJECT_ROOT, 'data')
 TRAJ_FILE = os.path.join(DATA_PATH, 'selected.csv')
+CHUNK_SIZE = 100000  # Number of rows read at a time from trip files
+SNAPSHOT_DIR = os.path.join(DATA_PATH, 'snapshot')
+
+# Columns of a trip file that trajectories can be built from: the sites or
+# the area codes of a trip
+TRAJ_COLUMNS = ('traj_site', 'traj_arr')
 
 THETA = 0.5  # p - risk threshold
 
@@ -22,23 +34,45 @@ class Trajectory(object):
     """ Movement trajectory (Def. 1). Different from the definition,
     we do not record time in trjectory, which should not affect the
     computation.
-    
+
+    Trajectories are interned: constructing one from the same locations
+    returns the same canonical instance while any reference to it is
+    alive. Equality is therefore identity. The intern table only holds
+    weak references, so the trajectories of a population are released with
+    it.
+
     Arguments:
         location
     """
-    def __init__(self, locations):
-        self.locations = tuple(locations)
-        
+    __slots__ = ('locations', '_hash', '__weakref__')
+
+    # A mapping from locations to the canonical instance
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, locations):
+        locations = tuple(locations)
+        traj = cls._interned.get(locations)
+        if traj is None:
+            traj = object.__new__(cls)
+            traj.locations = locations
+            traj._hash = hash(locations)
+            cls._interned[locations] = traj
+        return traj
+
+    def __reduce__(self):
+        # Re-intern on unpickling, as identity is local to a process.
+        return Trajectory, (self.locations,)
+
     def __hash__(self):
-        return hash(self.locations)
-    
+        return self._hash
+
     def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.locations == other.locations
-    
+        return self is other
+
     def __repr__(self):
         return '<Trajectory {}>'.format(str(self.locations))
 
-    
+
 class ITDBuilder(object):
     """ The builder class for ITD. """
     def __init__(self, uid):
@@ -48,69 +82,425 @@ class ITDBuilder(object):
     def add(self, trajectory):
         self.trajs[trajectory] += 1
 
+    def merge(self, other: 'ITDBuilder'):
+        self.trajs.update(other.trajs)
+
+
+class TrajectoryStore(object):
+    """ Columnar storage of the ITDs of a population in CSR form. The
+    trajectories of the user in row r are the entries in
+    [offsets[r], offsets[r + 1]), and each entry holds the id of the
+    trajectory in the global trajectory dictionary and its count.
+
+    Arguments:
+        uids: UIDs in the order of rows
+        offsets: row offsets into tids and counts, of length #users + 1
+        tids: trajectory id of each entry
+        counts: count of each entry
+        trajectories: trajectory dictionary, indexed by trajectory id
+    """
+    def __init__(self, uids, offsets, tids, counts, trajectories):
+        self.uids = list(uids)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.tids = np.asarray(tids, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.trajectories = list(trajectories)
+        self._uid2row = {uid: r for r, uid in enumerate(self.uids)}
+        self._t2tid = {t: i for i, t in enumerate(self.trajectories)}
+        self._by_tid = None
+
+    @classmethod
+    def from_counters(
+            cls,
+            counters: Iterable[Tuple[int, Mapping[Trajectory, int]]]
+            ) -> 'TrajectoryStore':
+        """ Builds the store from (UID, trajectory counts) pairs. """
+        uids, offsets, tids, counts = [], [0], [], []
+        t2tid = {}
+        for uid, trajs in counters:
+            uids += uid,
+            for traj, cnt in trajs.items():
+                tids += t2tid.setdefault(traj, len(t2tid)),
+                counts += cnt,
+            offsets += len(tids),
+        return cls(uids, offsets, tids, counts, t2tid.keys())
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def row(self, uid: int) -> int:
+        return self._uid2row[uid]
+
+    def tid(self, t: Trajectory) -> int:
+        """ Id of the trajectory, or -1 if no user has it. """
+        return self._t2tid.get(t, -1)
+
+    def span(self, row: int) -> slice:
+        return slice(self.offsets[row], self.offsets[row + 1])
+
+    def _row_index(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ The entries sorted by trajectory id within each row, and their
+        trajectory ids, built on first use.
+        """
+        if self._by_tid is None:
+            order = np.lexsort((self.tids, self.rows()))
+            self._by_tid = order, self.tids[order]
+        return self._by_tid
+
+    def entry(self, row: int, t: Trajectory) -> int:
+        """ Index of the entry of the trajectory in a row, or -1. """
+        tid = self.tid(t)
+        if tid < 0:
+            return -1
+        order, tids = self._row_index()
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        i = start + int(np.searchsorted(tids[start:end], tid))
+        return int(order[i]) if i < end and tids[i] == tid else -1
+
+    def rows(self) -> np.ndarray:
+        """ Row of each entry. """
+        return np.repeat(np.arange(len(self.uids)), np.diff(self.offsets))
+
+    def global_counts(self) -> np.ndarray:
+        """ Sum of the counts of each trajectory over all rows. """
+        return np.bincount(self.tids, weights=self.counts,
+                           minlength=len(self.trajectories)).astype(np.int64)
+
 
 class ITD(object):
-    """ Individual trajectory database (Def. 2, 3, 4, 5).
+    """ Individual trajectory database (Def. 2, 3, 4, 5), as a view over
+    one row of a TrajectoryStore.
     """
-    def __init__(self, builder, traj_freq):
-        self._uid = builder.uid
-        self._ts = []
-        self._t2idx = {}
-        self._t2cnt = {}
-        for idx, (traj, cnt) in enumerate(builder.trajs.items()):
-            self._ts += traj,
-            self._t2idx[traj] = idx
-            self._t2cnt[traj] = cnt
+    def __init__(self, store: TrajectoryStore, row: int):
+        self._store = store
+        self._row = row
 
     @property
     def uid(self) -> int:
-        return self._uid
+        return self._store.uids[self._row]
 
     @property
     def trajectories(self) -> List[Trajectory]:
-        return self._ts
+        store = self._store
+        return [store.trajectories[tid]
+                for tid in store.tids[store.span(self._row)].tolist()]
 
     def id(self, t: Trajectory) -> int:
-        if t not in self._t2idx:
+        entry = self._store.entry(self._row, t)
+        if entry < 0:
             raise Exception
-        return self._t2idx[t]
+        return int(entry - self._store.offsets[self._row])
 
     def count(self, t: Trajectory) -> int:
-        return self._t2cnt[t] if t in self._t2cnt else 0
+        entry = self._store.entry(self._row, t)
+        return int(self._store.counts[entry]) if entry >= 0 else 0
 
     def contains(self, t: Trajectory) -> bool:
-        return t in self._ts
-        
+        return self._store.entry(self._row, t) >= 0
+
     def __repr__(self) -> str:
         fmt_traj = ',\n     '.join(
-                'tid:{} cnt:{} {}'.format(self._t2idx[t], self._t2cnt[t], t)
-                for t in self._ts)
+                'tid:{} cnt:{} {}'.format(self.id(t), self.count(t), t)
+                for t in self.trajectories)
         return '<ITD uid:{}\n     {}>'.format(self.uid, fmt_traj)
 
 
-def load_ITDs() -> Dict[int, ITD]:
-    df = pd.read_csv(open(TRAJ_FILE, 'r'),
-                     header=0,
-                     names=['uid', 'date', 'traj_site', 'traj_arr'],
-                     parse_dates=['date'])
-    df['traj_site'] = df['traj_site'].apply(lambda x: literal_eval(x))
-    df['traj_arr'] = df['traj_arr'].apply(lambda x: literal_eval(x))
+class Population(dict):
+    """ A mapping from UID to ITD over a TrajectoryStore, with a global
+    trajectory-count index (the sum of the counts of each trajectory over
+    all ITDs) and an inverted index from each trajectory to the users
+    owning it with a positive count. Both indices are built on first use
+    unless given.
+    """
+    def __init__(self,
+                 store: TrajectoryStore,
+                 gcnt: Optional[np.ndarray] = None,
+                 t_offsets: Optional[np.ndarray] = None,
+                 t_rows: Optional[np.ndarray] = None):
+        super().__init__((uid, ITD(store, row))
+                         for row, uid in enumerate(store.uids))
+        self.store = store
+        self._gcnt = gcnt
+        self._t_offsets = t_offsets
+        self._t_rows = t_rows
+
+    @property
+    def gcnt(self) -> np.ndarray:
+        """ Global count of each trajectory, indexed by trajectory id. """
+        if self._gcnt is None:
+            self._gcnt = self.store.global_counts()
+        return self._gcnt
+
+    def _posting(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Rows of the entries sorted by trajectory id, so that the users
+        of trajectory tid are t_rows[t_offsets[tid]:t_offsets[tid + 1]].
+        """
+        if self._t_offsets is None or self._t_rows is None:
+            store = self.store
+            owned = np.flatnonzero(store.counts > 0)
+            tids = store.tids[owned]
+            self._t_offsets = np.concatenate([[0], np.cumsum(np.bincount(
+                    tids, minlength=len(store.trajectories)))])
+            self._t_rows = store.rows()[owned][np.argsort(tids, kind='stable')]
+        return self._t_offsets, self._t_rows
+
+    @classmethod
+    def of(cls, itds: Dict[int, ITD]) -> 'Population':
+        if isinstance(itds, cls):
+            return itds
+        return cls(TrajectoryStore.from_counters(
+                (uid, {t: itd.count(t) for t in itd.trajectories})
+                for uid, itd in itds.items()))
+
+    def global_count(self, t: Trajectory) -> int:
+        tid = self.store.tid(t)
+        return int(self.gcnt[tid]) if tid >= 0 else 0
+
+    def users(self, t: Trajectory) -> Set[int]:
+        """ UIDs of the users whose ITD has a positive count of the
+        trajectory.
+        """
+        tid = self.store.tid(t)
+        if tid < 0:
+            return set()
+        t_offsets, t_rows = self._posting()
+        rows = t_rows[t_offsets[tid]:t_offsets[tid + 1]]
+        return {self.store.uids[row] for row in rows.tolist()}
 
-    # For ITD
-    traj_freq = collections.Counter()
+    def add_count(self, uid: int, t: Trajectory, delta: int):
+        """ Changes the count of a trajectory in an ITD by delta and
+        keeps the global count index and the users of the trajectory in
+        sync.
+        """
+        entry = self.store.entry(self.store.row(uid), t)
+        if entry < 0:
+            raise ValueError('{} is not in ITD {}'.format(t, uid))
+        gcnt = self.gcnt
+        before = int(self.store.counts[entry])
+        self.store.counts[entry] += delta
+        gcnt[self.store.tids[entry]] += delta
+        if (before > 0) != (before + delta > 0):
+            # The users of the trajectory changed, and the inverted index
+            # is rebuilt on its next use.
+            self._t_offsets = self._t_rows = None
+
+
+def _parse_tuple(text: str) -> Tuple[int, ...]:
+    """ Parses a tuple of integers written as in '(1,3,5)'. A set written
+    as in '{3,5,7}' gives the elements in set order, as literal_eval
+    followed by tuple() does.
+    """
+    text = text.strip()
+    values = [int(x) for x in text[1:-1].split(',') if x.strip()]
+    return tuple(set(values)) if text[0] == '{' else tuple(values)
+
+
+def _read_trips(
+        path: str,
+        chunksize: int,
+        traj_column: str
+        ) -> Iterator[Tuple[int, Tuple[int, ...]]]:
+    """ Streams the (uid, trajectory) of each trip in a trip file, reading
+    chunksize rows at a time. Only the uid and the given trajectory
+    column are read.
+    """
+    chunks = pd.read_csv(path,
+                         header=0,
+                         names=['uid', 'date', 'traj_site', 'traj_arr'],
+                         usecols=['uid', traj_column],
+                         dtype={traj_column: str},
+                         chunksize=chunksize)
+    for df in chunks:
+        for uid, traj in zip(df['uid'].tolist(), df[traj_column].tolist()):
+            yield uid, _parse_tuple(traj)
+
+
+def _build_ITDs(
+        path: str,
+        chunksize: int,
+        traj_column: str
+        ) -> List[ITDBuilder]:
+    """ Builds the partial ITDs of the users in one trip file.
+    """
     itd_bdlrs = {}
-    for _, (uid, date, sites, areas) in df.iterrows():
-        # Costruct trajectory using area codes.
-        traj = Trajectory(areas)
+    for uid, locations in _read_trips(path, chunksize, traj_column):
+        traj = Trajectory(locations)
         if uid not in itd_bdlrs:
             itd_bdlrs[uid] = ITDBuilder(uid)
         itd_bdlrs[uid].add(traj)
-        traj_freq[traj] += 1
+    return list(itd_bdlrs.values())
+
+
+def _trip_files(paths: Union[str, List[str]]) -> List[str]:
+    """ Lists trip files given a path, a glob pattern or a list of them.
+    Files matching a pattern are sorted by name.
+    """
+    files = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        if any(c in path for c in '*?['):
+            files += sorted(glob.glob(path))
+        else:
+            files += path,
+    if not files:
+        raise FileNotFoundError("No trip file matches {}".format(paths))
+    return files
+
+
+def load_ITDs(
+        paths: Union[str, List[str]] = TRAJ_FILE,  # Trip files or globs
+        chunksize: int = CHUNK_SIZE,   # Number of rows read at a time
+        workers: Optional[int] = None, # Number of processes, all CPUs if None
+        traj_column: str = 'traj_arr'  # One of TRAJ_COLUMNS
+        ) -> Population:
+    if traj_column not in TRAJ_COLUMNS:
+        raise ValueError("Unknown trajectory column: {}".format(traj_column))
+    files = _trip_files(paths)
+    if workers is None:
+        workers = min(len(files), os.cpu_count() or 1)
+
+    # Partial ITDs per file, in the order of files
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(_build_ITDs, files,
+                                      [chunksize] * len(files),
+                                      [traj_column] * len(files)))
+    else:
+        parts = [_build_ITDs(f, chunksize, traj_column) for f in files]
+
+    # Merge the partial ITDs in file order, so that the users and their
+    # trajectories are ordered as if the files were concatenated.
+    itd_bdlrs = {}
+    for part in parts:
+        for bdlr in part:
+            if bdlr.uid not in itd_bdlrs:
+                itd_bdlrs[bdlr.uid] = ITDBuilder(bdlr.uid)
+            itd_bdlrs[bdlr.uid].merge(bdlr)
     # A mapping from user ID to the crossponding ITD
-    ITDs = {bdlr.uid: ITD(bdlr, traj_freq) for bdlr in itd_bdlrs.values()}
+    ITDs = Population(TrajectoryStore.from_counters(
+            (bdlr.uid, bdlr.trajs) for bdlr in itd_bdlrs.values()))
 
-    log.debug(
-            "Loading ITDs\n" +
-            "\n".join(repr(itd) for _, itd in ITDs.items()))
+    log.debug("Loading ITDs\n%s", Lazy(
+            lambda: "\n".join(repr(itd) for _, itd in ITDs.items())))
 
     return ITDs
+
+
+# Arrays of a snapshot, and whether they are modified after loading. The
+# modifiable ones are mapped copy-on-write.
+_SNAPSHOT_ARRAYS = {
+    'offsets': False,
+    'tids': False,
+    'counts': True,
+    'traj_offsets': False,
+    'traj_locations': False,
+    'gcnt': True,
+    't_offsets': False,
+    't_rows': False,
+}
+
+
+def _fingerprint(files: List[str], traj_column: str) -> str:
+    """ Fingerprints trip files by their paths, sizes and modified times,
+    and the column trajectories are built from.
+    """
+    digest = hashlib.sha1(traj_column.encode())
+    for f in files:
+        stat = os.stat(f)
+        digest.update('{}:{}:{}\n'.format(
+                os.path.abspath(f), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def save_snapshot(itds: Population, path: str, fingerprint: str = ''):
+    """ Saves a population as .npy files in a directory. The files are
+    written to a temporary sibling directory, with the metadata file last,
+    which then replaces the directory. The files of an earlier snapshot are
+    never overwritten, so processes that have them memory-mapped keep
+    reading the earlier population.
+    """
+    path = os.path.abspath(path)
+    parent, name = os.path.split(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=name + '.', dir=parent)
+    try:
+        _write_snapshot(itds, tmp, fingerprint)
+        if os.path.exists(path):
+            # A non-empty directory cannot be replaced, so the earlier
+            # snapshot is moved aside and removed. Mapped files stay
+            # readable after they are unlinked.
+            old = tmp + '.old'
+            os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.rename(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def _write_snapshot(itds: Population, path: str, fingerprint: str):
+    store = itds.store
+    locations = [t.locations for t in store.trajectories]
+    arrays = {
+        'offsets': store.offsets,
+        'tids': store.tids,
+        'counts': store.counts,
+        'traj_offsets': np.concatenate(
+                [[0], np.cumsum([len(l) for l in locations], dtype=np.int64)]),
+        'traj_locations': np.fromiter(
+                (x for l in locations for x in l), np.int64),
+        'gcnt': itds.gcnt,
+        't_offsets': itds._posting()[0],
+        't_rows': itds._posting()[1],
+    }
+    for name in _SNAPSHOT_ARRAYS:
+        np.save(os.path.join(path, name + '.npy'),
+                np.asarray(arrays[name], dtype=np.int64))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'uids': store.uids}, f)
+
+
+def load_snapshot(path: str, mmap: bool = True) -> Population:
+    """ Loads a population saved by save_snapshot. With mmap, the arrays
+    are memory-mapped so that processes loading the same snapshot share
+    their pages.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'),
+                            mmap_mode=('c' if writable else 'r')
+                                      if mmap else None)
+              for name, writable in _SNAPSHOT_ARRAYS.items()}
+    locations = arrays['traj_locations'].tolist()
+    bounds = arrays['traj_offsets'].tolist()
+    trajectories = [Trajectory(locations[start:end])
+                    for start, end in zip(bounds[:-1], bounds[1:])]
+    store = TrajectoryStore(meta['uids'], arrays['offsets'], arrays['tids'],
+                            arrays['counts'], trajectories)
+    return Population(store, arrays['gcnt'], arrays['t_offsets'],
+                      arrays['t_rows'])
+
+
+def load_population(
+        paths: Union[str, List[str]] = TRAJ_FILE,  # Trip files or globs
+        snapshot: str = SNAPSHOT_DIR,   # Snapshot directory
+        **kwargs                        # Arguments of load_ITDs
+        ) -> Population:
+    """ Loads a population from its snapshot, or from the trip files if the
+    snapshot is missing or the files have changed since it was saved.
+    """
+    fingerprint = _fingerprint(_trip_files(paths),
+                               kwargs.get('traj_column', 'traj_arr'))
+    try:
+        with open(os.path.join(snapshot, 'meta.json')) as f:
+            if json.load(f)['fingerprint'] == fingerprint:
+                log.info("Loading ITDs from snapshot %s", snapshot)
+                return load_snapshot(snapshot)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    itds = load_ITDs(paths, **kwargs)
+    save_snapshot(itds, snapshot, fingerprint)
+    log.info("Saved ITD snapshot to %s", snapshot)
+    return itds
@@ -66,7 +66,21 @@ class LogFormatter(logging.Formatter):
         return self._fmt % record.__dict__
 
 
-def setup_logger(logger, level=logging.DEBUG):
+class Lazy(object):
+    """ A log message argument that is only evaluated when the record is
+    emitted, e.g. log.debug("L = %s", Lazy(lambda: format(mat))). Records
+    below the logger level never call the function.
+    """
+    __slots__ = ('_fn',)
+
+    def __init__(self, fn):
+        self._fn = fn
+
+    def __str__(self):
+        return str(self._fn())
+
+
+def setup_logger(logger, level=logging.INFO):
     logger.setLevel(level)
 
     hdlr = logging.StreamHandler(sys.stdout)
@@ -3,7 +3,7 @@ import data
 
 
 def main():
-    itds = data.load_ITDs()
+    itds = data.load_population()
     noise = algo.sanitize(itds)
 
     for uid, itd in itds.items():
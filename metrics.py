@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import *
+
+from log import Lazy, log
+
+
+class Metrics(object):
+    """ Wall time, call counts and sizes of named phases, and named
+    counters, recorded in total and per sanitize round. A disabled
+    instance records nothing, so the hooks cost one attribute check.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self._total = self._new_scope()
+        self._rounds = []
+        self._round = None  # Scope of the round being recorded
+
+    @staticmethod
+    def _new_scope() -> Dict[str, Any]:
+        return {'phases': defaultdict(lambda: {'calls': 0, 'time': 0.0,
+                                               'size': 0}),
+                'counters': defaultdict(int)}
+
+    def _scopes(self) -> List[Dict[str, Any]]:
+        if self._round is None:
+            return [self._total]
+        return [self._total, self._round]
+
+    def new_round(self, round_: int):
+        """ Starts recording the metrics of a sanitize round. """
+        if self.enabled:
+            self._round = dict(self._new_scope(), round=round_)
+            self._rounds.append(self._round)
+
+    def end_round(self):
+        """ Stops recording the metrics of the current round, so that later
+        metrics only count in the totals.
+        """
+        self._round = None
+
+    @contextmanager
+    def rounds(self):
+        """ Ends the last round started in the enclosed block on exit. """
+        try:
+            yield
+        finally:
+            self.end_round()
+
+    @contextmanager
+    def phase(self, name: str, size: int = 0):
+        """ Times the enclosed block as one call of a phase, processing
+        size items.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            for scope in self._scopes():
+                stats = scope['phases'][name]
+                stats['calls'] += 1
+                stats['time'] += elapsed
+                stats['size'] += size
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            for scope in self._scopes():
+                scope['counters'][name] += n
+
+    def report(self, rounds: bool = True) -> Dict[str, Any]:
+        """ Returns the metrics as plain dicts, with the per-round metrics
+        under 'rounds'.
+        """
+        def plain(scope):
+            return dict(scope,
+                        phases={k: dict(v) for k, v in scope['phases'].items()},
+                        counters=dict(scope['counters']))
+        report = plain(self._total)
+        if rounds:
+            report['rounds'] = [plain(scope) for scope in self._rounds]
+        return report
+
+    def to_json(self, rounds: bool = True, **kwargs) -> str:
+        return json.dumps(self.report(rounds), **kwargs)
+
+    def emit(self, logger: logging.Logger = log):
+        """ Logs the totals at INFO and the per-round metrics at DEBUG. """
+        if self.enabled:
+            logger.info("metrics = %s", Lazy(lambda: self.to_json(False)))
+            logger.debug("metrics per round = %s", Lazy(
+                    lambda: json.dumps(self.report()['rounds'])))
+
+
+# Metrics of the algorithms. Set DP_METRICS=0 to switch them off.
+metrics = Metrics(enabled=os.environ.get('DP_METRICS', '1') != '0')